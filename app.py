@@ -4,9 +4,6 @@ from io import BytesIO
 
 import pandas as pd
 import streamlit as st
-from openpyxl import Workbook
-from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
-from openpyxl.utils import get_column_letter
 
 from db import (
     init_db,
@@ -17,6 +14,8 @@ from db import (
     admin_delete_record,
     upsert_records_from_excel,
     get_db_path,
+    matrix_styles,
+    styled_cell,
 )
 
 st.set_page_config(page_title="Registro de Actividades", layout="wide")
@@ -49,6 +48,16 @@ def add_months(base: date, months: int) -> date:
     last_day = (next_first - timedelta(days=1)).day
     return first_of_month.replace(day=min(base.day, last_day))
 
+@st.cache_data(ttl=60, show_spinner=False)
+def cached_month_records(date_from_iso: str, date_to_iso: str, specialist: str | None = None) -> pd.DataFrame:
+    # Claves ISO (hashables); se invalida con cached_month_records.clear() tras cada escritura
+    return get_month_records(date.fromisoformat(date_from_iso), date.fromisoformat(date_to_iso), specialist=specialist)
+
+@st.cache_data(show_spinner=False, max_entries=4, ttl=600)
+def read_uploaded_excel(data: bytes) -> pd.DataFrame:
+    # pandas ya abre el libro con openpyxl en modo read_only; el caché evita re-parsearlo en cada rerun
+    return pd.read_excel(BytesIO(data), engine="openpyxl")
+
 def get_admin_code() -> str | None:
     # Prefer Streamlit secrets, fallback to env var
     try:
@@ -148,15 +157,9 @@ with tab_reg:
             # Build date list
             fechas = []
             if f_ini <= f_fin:
-                cur = f_ini
-                map_wd = {0: "Lun", 1: "Mar", 2: "Mié", 3: "Jue", 4: "Vie", 5: "Sáb", 6: "Dom"}
-                allowed = set(dias) if dias else set(map_wd.values())
-                weekend_selected = bool(allowed.intersection({"Sáb", "Dom"}))
-                while cur <= f_fin:
-                    wd = map_wd[cur.weekday()]
-                    if wd in allowed and (incluir_finde or wd not in {"Sáb", "Dom"} or weekend_selected):
-                        fechas.append(cur)
-                    cur += timedelta(days=1)
+                map_wd = {"Lun": "Mon", "Mar": "Tue", "Mié": "Wed", "Jue": "Thu", "Vie": "Fri", "Sáb": "Sat", "Dom": "Sun"}
+                weekmask = " ".join(map_wd[d] for d in (dias or map_wd))
+                fechas = list(pd.bdate_range(f_ini, f_fin, freq="C", weekmask=weekmask).date)
 
         notas = st.text_area("Notas / detalle (opcional)", placeholder="Criterios, entregables, etc.")
         submitted = st.form_submit_button("Registrar")
@@ -205,6 +208,7 @@ with tab_reg:
                 for f in fechas
             ]
             add_scheduled_records(records)
+            cached_month_records.clear()
             st.success(f"Listo: se registraron {len(records)} actividad(es).")
 
 # --- Mis actividades del día / Marcar estado ---
@@ -216,7 +220,8 @@ with tab_estado:
         if not admin_mode:
             rango_ini = today
             rango_fin = today
-            df = get_month_records(rango_ini, rango_fin, specialist=actor_name.strip())
+            alcance = actor_name.strip()
+            df = cached_month_records(rango_ini.isoformat(), rango_fin.isoformat(), specialist=alcance)
             st.caption("Solo se muestran tus actividades programadas para hoy.")
         else:
             c1, c2, c3 = st.columns([2, 2, 2])
@@ -226,21 +231,26 @@ with tab_estado:
                 rango_ini = st.date_input("Desde", value=month_first)
             with c3:
                 rango_fin = st.date_input("Hasta", value=month_last)
-            df = get_month_records(rango_ini, rango_fin, specialist=(filtro_especialista.strip() or None))
+            alcance = filtro_especialista.strip() or None
+            df = cached_month_records(rango_ini.isoformat(), rango_fin.isoformat(), specialist=alcance)
 
         if df.empty:
             st.warning("No hay registros en el rango seleccionado.")
         else:
-            df = df.sort_values(["scheduled_date", "specialist", "activity"]).reset_index(drop=True)
-            original = df.copy()
+            # Índice = id: los ids forman parte de la identidad del editor, así un reordenamiento descarta ediciones pendientes
+            df = df.sort_values(["scheduled_date", "specialist", "activity"]).set_index("id")
+            # Solo las columnas que compara el guardado (estado y notas)
+            original = df[["status", "notes"]]
 
             st.caption("Edita **Estado** y **Notas**. Solo administrador puede cambiar fecha programada.")
-            edited = st.data_editor(
+            # Clave estable por rango/filtro: el guardado lee solo el delta (edited_rows) del editor
+            editor_key = f"editor_estado_{rango_ini.isoformat()}_{rango_fin.isoformat()}_{alcance or ''}"
+            st.data_editor(
                 df,
-                hide_index=True,
+                hide_index=False,
                 use_container_width=True,
                 column_config={
-                    "id": st.column_config.NumberColumn("ID", disabled=True),
+                    "_index": st.column_config.NumberColumn("ID", disabled=True),
                     "scheduled_date": st.column_config.DateColumn("Fecha", disabled=not is_admin),
                     "specialist": st.column_config.TextColumn("Especialista", disabled=True),
                     "activity": st.column_config.TextColumn("Actividad", disabled=True),
@@ -249,32 +259,31 @@ with tab_estado:
                     "notes": st.column_config.TextColumn("Notas", width="large"),
                     "updated_at": st.column_config.TextColumn("Actualizado", disabled=True),
                 },
+                key=editor_key,
             )
 
             col_save, col_hint = st.columns([1, 3])
             with col_save:
                 if st.button("Guardar cambios"):
                     changes = []
-                    for _, row in edited.iterrows():
-                        rid = int(row["id"])
-                        old = original.loc[original["id"] == rid].iloc[0]
-                        if not is_admin and row["scheduled_date"] != old["scheduled_date"]:
+                    for pos, delta in st.session_state[editor_key]["edited_rows"].items():
+                        rid = int(df.index[int(pos)])
+                        old = original.loc[rid]
+                        if not is_admin and "scheduled_date" in delta:
                             st.error(f"No autorizado: el registro ID {rid} cambió fecha. Se ignorará ese cambio.")
-                            row["scheduled_date"] = old["scheduled_date"]
-                        if (row["status"] != old["status"]) or (str(row["notes"]) != str(old["notes"])):
-                            changes.append(
-                                {
-                                    "id": rid,
-                                    "status": row["status"],
-                                    "notes": row["notes"] if pd.notna(row["notes"]) else "",
-                                    "actor": actor_name.strip(),
-                                }
-                            )
+                        old_status = old["status"] if pd.notna(old["status"]) else ""
+                        old_notes = old["notes"] if pd.notna(old["notes"]) else ""
+                        status = delta.get("status", old_status) or ""
+                        notes = delta.get("notes", old_notes) or ""
+                        if status != old_status or notes != old_notes:
+                            changes.append({"id": rid, "status": status, "notes": notes, "actor": actor_name.strip()})
 
                     if not changes:
                         st.info("No detecté cambios para guardar.")
                     else:
                         update_records_status_and_notes(changes)
+                        cached_month_records.clear()
+                        st.session_state.pop(editor_key, None)
                         st.success(f"Guardado: {len(changes)} cambio(s).")
                         st.rerun()
             with col_hint:
@@ -287,19 +296,19 @@ with tab_cal:
         st.info("Escribe tu nombre para visualizar tu calendario.")
     else:
         specialist_scope = actor_name.strip() if not admin_mode else None
-        dfc = get_month_records(month_first, month_last, specialist=specialist_scope)
+        dfc = cached_month_records(month_first.isoformat(), month_last.isoformat(), specialist=specialist_scope)
 
         if dfc.empty:
             st.info("Aún no hay actividades registradas en el mes seleccionado.")
         else:
-            dfc["scheduled_date"] = pd.to_datetime(dfc["scheduled_date"]).dt.date
             dfc["day"] = pd.to_datetime(dfc["scheduled_date"]).dt.day
 
             if not admin_mode:
                 st.caption("Solo ves tus actividades del mes seleccionado.")
                 matriz = (
-                    dfc.assign(carga=1)
-                    .pivot_table(index="activity", columns="day", values="carga", aggfunc="sum", fill_value=0)
+                    dfc.groupby(["activity", "day"], observed=True)
+                    .size()
+                    .unstack(fill_value=0)
                     .reindex(columns=list(range(1, month_last.day + 1)), fill_value=0)
                     .reset_index()
                 )
@@ -322,24 +331,25 @@ with tab_cal:
                 )
 
                 matriz_carga = (
-                    dfc.assign(carga=1)
-                    .pivot_table(index="specialist", columns="day", values="carga", aggfunc="sum", fill_value=0)
+                    dfc.groupby(["specialist", "day"], observed=True)
+                    .size()
+                    .unstack(fill_value=0)
                     .reindex(columns=list(range(1, month_last.day + 1)), fill_value=0)
                     .reset_index()
                 )
                 matriz_carga["Total mes"] = matriz_carga.drop(columns=["specialist"]).sum(axis=1)
                 st.dataframe(matriz_carga, use_container_width=True, hide_index=True)
 
-                dfd = dfc[dfc["scheduled_date"] == dia_consulta].copy()
+                dfd = dfc[dfc["scheduled_date"] == dia_consulta]
                 if dfd.empty:
                     st.info(f"No hay actividades programadas para el día {dia_consulta.isoformat()}.")
                 else:
                     st.markdown(f"**Actividades del día {dia_consulta.isoformat()} agrupadas por especialista**")
-                    grouped = dfd.sort_values(["specialist", "activity"]).groupby("specialist", as_index=False)
+                    grouped = dfd.sort_values(["specialist", "activity"]).groupby("specialist", as_index=False, observed=True)
                     for _, row in grouped:
                         especialista = row["specialist"].iloc[0]
                         with st.expander(f"👤 {especialista} ({len(row)} actividad(es))", expanded=True):
-                            show = row[["activity", "unit", "status", "notes"]].copy()
+                            show = row[["activity", "unit", "status", "notes"]]
                             show.columns = ["Actividad", "UM", "Estado", "Notas"]
                             st.dataframe(show, use_container_width=True, hide_index=True)
 
@@ -357,7 +367,7 @@ with tab_lote:
 
     if archivo_lote is not None:
         try:
-            df_lote = pd.read_excel(archivo_lote)
+            df_lote = read_uploaded_excel(archivo_lote.getvalue())
             df_lote.columns = [str(c).strip().lower() for c in df_lote.columns]
 
             rename_map = {
@@ -390,7 +400,7 @@ with tab_lote:
                 if df_lote.empty:
                     st.info("No hay filas disponibles para edición con el filtro actual.")
                 else:
-                    editable = df_lote[["id", "specialist", "activity", "unit", "scheduled_date", "status", "notes"]].copy()
+                    editable = df_lote[["id", "specialist", "activity", "unit", "scheduled_date", "status", "notes"]]
                     edited_lote = st.data_editor(
                         editable,
                         use_container_width=True,
@@ -423,6 +433,7 @@ with tab_lote:
                         records = edited_lote.fillna("").to_dict("records")
                         actor = (actor_name or "IMPORTADOR").strip()
                         inserted, updated, errors = upsert_records_from_excel(records, actor)
+                        cached_month_records.clear()
                         st.success(f"Proceso masivo completado. Insertados: {inserted} | Actualizados: {updated}")
                         if errors:
                             st.warning("Se detectaron filas con error:")
@@ -440,26 +451,28 @@ with tab_export:
     st.markdown("### Plantilla de carga masiva")
     st.caption("Descarga esta plantilla, llénala y súbela para actualizar automáticamente registros.")
 
-    plantilla_df = pd.DataFrame([
-        {
-            "id": "",
-            "especialista": "",
-            "actividad": "",
-            "unidad": "",
-            "fecha_programada": "YYYY-MM-DD",
-            "estado": "",
-            "notas": "",
-        }
-    ])
-    template_bio = BytesIO()
-    with pd.ExcelWriter(template_bio, engine="openpyxl") as writer:
-        plantilla_df.to_excel(writer, sheet_name="plantilla", index=False)
-    st.download_button(
-        label="Descargar plantilla para importar",
-        data=template_bio.getvalue(),
-        file_name="plantilla_carga_actividades.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    )
+    if st.button("Generar plantilla"):
+        # Igual que la matriz: la plantilla (y openpyxl) solo se construyen a pedido
+        plantilla_df = pd.DataFrame([
+            {
+                "id": "",
+                "especialista": "",
+                "actividad": "",
+                "unidad": "",
+                "fecha_programada": "YYYY-MM-DD",
+                "estado": "",
+                "notas": "",
+            }
+        ])
+        template_bio = BytesIO()
+        with pd.ExcelWriter(template_bio, engine="openpyxl") as writer:
+            plantilla_df.to_excel(writer, sheet_name="plantilla", index=False)
+        st.download_button(
+            label="Descargar plantilla para importar",
+            data=template_bio.getvalue(),
+            file_name="plantilla_carga_actividades.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
 
     archivo_subido = st.file_uploader(
         "Subir Excel para actualización automática",
@@ -469,7 +482,7 @@ with tab_export:
 
     if archivo_subido is not None:
         try:
-            df_in = pd.read_excel(archivo_subido)
+            df_in = read_uploaded_excel(archivo_subido.getvalue())
             df_in.columns = [str(c).strip().lower() for c in df_in.columns]
 
             rename_map = {
@@ -513,6 +526,7 @@ with tab_export:
                 if st.button("Procesar importación"):
                     actor = (actor_name or "IMPORTADOR").strip()
                     inserted, updated, errors = upsert_records_from_excel(records, actor)
+                    cached_month_records.clear()
                     st.success(f"Importación completada. Insertados: {inserted} | Actualizados: {updated}")
                     if errors:
                         st.warning("Se detectaron filas con error:")
@@ -539,7 +553,11 @@ with tab_export:
         exp_especialista = st.text_input("Filtrar por especialista (opcional)", value="")
 
     if st.button("Generar Excel"):
-        df_export = get_month_records(exp_from, exp_to, specialist=(exp_especialista.strip() or None))
+        # openpyxl solo se carga al exportar, no en cada arranque de la app
+        from openpyxl import Workbook
+        from openpyxl.utils import get_column_letter
+
+        df_export = cached_month_records(exp_from.isoformat(), exp_to.isoformat(), specialist=(exp_especialista.strip() or None))
 
         if df_export.empty:
             wb = Workbook()
@@ -554,15 +572,9 @@ with tab_export:
             # ✓ = cumplido, ✗ = incumplido (incluye vencidos sin marcar), + = pendiente
             today_ref = date.today()
 
-            def excel_symbol(row) -> str:
-                if row["status"] == "✓":
-                    return "✓"
-                if row["status"] == "✗" or row["scheduled_date"] < today_ref:
-                    return "✗"
-                return "+"
-
-            df_export["symbol"] = df_export.apply(excel_symbol, axis=1)
-            df_export["scheduled_date"] = pd.to_datetime(df_export["scheduled_date"]).dt.date
+            df_export["symbol"] = "+"
+            df_export.loc[(df_export["status"] == "✗") | (df_export["scheduled_date"] < today_ref), "symbol"] = "✗"
+            df_export.loc[df_export["status"] == "✓", "symbol"] = "✓"
             days = pd.date_range(exp_from, exp_to, freq="D").date
             pivot = df_export.pivot_table(
                 index=["specialist", "activity", "unit"],
@@ -570,63 +582,42 @@ with tab_export:
                 values="symbol",
                 aggfunc="first",
                 fill_value="",
+                observed=True,
             ).reindex(columns=list(days), fill_value="").reset_index()
 
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Matriz"
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet("Matriz")
             ws.sheet_view.showGridLines = False
 
-            header_fill = PatternFill("solid", fgColor="1F4E79")
-            header_font = Font(color="FFFFFF", bold=True)
-            thin = Side(style="thin", color="9E9E9E")
-            border_thin = Border(left=thin, right=thin, top=thin, bottom=thin)
-            center = Alignment(horizontal="center", vertical="center", wrap_text=True)
-            left = Alignment(horizontal="left", vertical="center", wrap_text=True)
-
-            ws["A1"] = f"Matriz {periodo_export.lower()}: {exp_from.isoformat()} a {exp_to.isoformat()}"
-            ws["A1"].font = Font(size=14, bold=True, color="1F4E79")
-            ws.merge_cells("A1:AI1")
-
-            ws["A2"] = "Leyenda: ✓ cumplido | ✗ incumplido/vencido | + pendiente"
-            ws["A2"].font = Font(size=11, color="1F4E79")
-            ws.merge_cells("A2:AI2")
-
-            header_row = 4
-            headers = ["Especialista", "Actividad", "Unidad de medida"]
-
-            for j, h in enumerate(headers, start=1):
-                c = ws.cell(row=header_row, column=j, value=h)
-                c.fill = header_fill
-                c.font = header_font
-                c.alignment = center
-                c.border = border_thin
-
-            for i_day, day in enumerate(days, start=1):
-                col = 3 + i_day
-                c = ws.cell(row=header_row, column=col, value=day.strftime("%d/%m"))
-                c.fill = header_fill
-                c.font = header_font
-                c.alignment = center
-                c.border = border_thin
+            sty = matrix_styles()
 
+            # En modo write_only los anchos y merges se fijan antes de escribir filas
             ws.column_dimensions["A"].width = 24
             ws.column_dimensions["B"].width = 38
             ws.column_dimensions["C"].width = 18
             for i_day, _ in enumerate(days, start=1):
                 ws.column_dimensions[get_column_letter(3 + i_day)].width = 6.5
-
-            start_row = header_row + 1
-            for i, (_, row) in enumerate(pivot.iterrows(), start=start_row):
-                ws.cell(i, 1, row["specialist"]).alignment = left
-                ws.cell(i, 2, row["activity"]).alignment = left
-                ws.cell(i, 3, row["unit"]).alignment = center
-                for c in range(1, 3 + len(days) + 1):
-                    ws.cell(i, c).border = border_thin
-
-                for i_day, day in enumerate(days, start=1):
-                    val = row[day] if day in row.index else ""
-                    ws.cell(i, 3 + i_day, val).alignment = center
+            ws.merged_cells.add("A1:AI1")
+            ws.merged_cells.add("A2:AI2")
+
+            ws.append([styled_cell(ws, f"Matriz {periodo_export.lower()}: {exp_from.isoformat()} a {exp_to.isoformat()}", **sty["title"])])
+            ws.append([styled_cell(ws, "Leyenda: ✓ cumplido | ✗ incumplido/vencido | + pendiente", **sty["legend"])])
+            ws.append([])
+
+            headers = ["Especialista", "Actividad", "Unidad de medida"] + [day.strftime("%d/%m") for day in days]
+            ws.append([styled_cell(ws, h, **sty["header"]) for h in headers])
+
+            meta = pivot[["specialist", "activity", "unit"]].to_numpy(dtype=object)
+            day_vals = pivot[list(days)].to_numpy(dtype=object)
+            for (especialista, actividad, unidad), vals in zip(meta, day_vals):
+                ws.append(
+                    [
+                        styled_cell(ws, especialista, **sty["left"]),
+                        styled_cell(ws, actividad, **sty["left"]),
+                        styled_cell(ws, unidad, **sty["center"]),
+                    ]
+                    + [styled_cell(ws, val, **sty["center"]) for val in vals]
+                )
 
             bio = BytesIO()
             wb.save(bio)
@@ -669,6 +660,7 @@ with tab_admin:
                     reason=motivo.strip() or "—",
                 )
                 if ok:
+                    cached_month_records.clear()
                     st.success("Fecha actualizada.")
                 else:
                     st.error("No se pudo actualizar (ID no encontrado).")
@@ -677,6 +669,7 @@ with tab_admin:
             if st.button("Borrar registro"):
                 ok = admin_delete_record(int(rid), actor=actor_name.strip() or "ADMIN", reason=motivo.strip() or "—")
                 if ok:
+                    cached_month_records.clear()
                     st.success("Registro borrado.")
                 else:
                     st.error("No se pudo borrar (ID no encontrado).")
@@ -3,18 +3,64 @@ from __future__ import annotations
 import os
 import shutil
 import sqlite3
+import threading
 from datetime import datetime, date, timedelta
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Iterable
+from typing import TYPE_CHECKING, Any, Iterable
 
 import pandas as pd
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from openpyxl.utils import get_column_letter
+
+if TYPE_CHECKING:
+    from openpyxl.cell import Cell
 
 DB_DIR = Path(os.getenv("APP_DATA_DIR", Path(__file__).resolve().parent / "data"))
 DB_PATH = DB_DIR / "app.db"
 BACKUP_DIR = DB_DIR / "backups"
+STATUS_DTYPE = pd.CategoricalDtype(["", "✓", "✗"])
+
+_wal_set = False
+_conn: sqlite3.Connection | None = None
+_conn_lock = threading.RLock()
+
+# Statements reused on every write; the connection keeps them compiled in its statement cache
+_INSERT_SCHEDULED_SQL = """
+INSERT INTO scheduled_activities
+(specialist, activity, unit, scheduled_date, status, notes, created_at, created_by)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_UPDATE_STATUS_NOTES_SQL = """
+UPDATE scheduled_activities
+SET status = ?, notes = ?, updated_at = ?, updated_by = ?
+WHERE id = ?
+"""
+# VALUES columns are exposed by SQLite as column1..column4 (id, status, notes, actor)
+_UPDATE_STATUS_NOTES_FROM_VALUES_SQL = """
+UPDATE scheduled_activities
+SET status = v.column2, notes = v.column3, updated_at = ?, updated_by = v.column4
+FROM (VALUES {values}) AS v
+WHERE scheduled_activities.id = v.column1
+"""
+_UPDATE_BATCH_ROWS = 500
+_SELECT_ID_SQL = "SELECT id FROM scheduled_activities WHERE id = ?"
+_UPSERT_UPDATE_SQL = """
+UPDATE scheduled_activities
+SET specialist = ?, activity = ?, unit = ?, scheduled_date = ?, status = ?, notes = ?, updated_at = ?, updated_by = ?
+WHERE id = ?
+"""
+_UPSERT_INSERT_SQL = """
+INSERT INTO scheduled_activities
+(specialist, activity, unit, scheduled_date, status, notes, created_at, created_by, updated_at, updated_by)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_SELECT_SCHEDULED_DATE_SQL = "SELECT scheduled_date FROM scheduled_activities WHERE id = ?"
+_UPDATE_SCHEDULED_DATE_SQL = "UPDATE scheduled_activities SET scheduled_date = ?, updated_at = ?, updated_by = ? WHERE id = ?"
+_NORMALIZE_SCHEDULED_DATE_SQL = "UPDATE scheduled_activities SET scheduled_date = ? WHERE id = ?"
+_DELETE_SCHEDULED_SQL = "DELETE FROM scheduled_activities WHERE id = ?"
+_INSERT_AUDIT_SQL = """
+INSERT INTO audit_log (action, record_id, old_scheduled_date, new_scheduled_date, actor, reason, ts)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
 
 def get_db_path() -> str:
     return str(DB_PATH)
@@ -35,20 +81,42 @@ def _backup_db() -> None:
     backup_name = f"app_{datetime.now().strftime('%Y%m%d')}.db"
     backup_path = BACKUP_DIR / backup_name
     if not backup_path.exists():
+        # In WAL mode recent commits live in app.db-wal; fold them in before copying
+        with _conn_lock, get_conn() as conn:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
         shutil.copy2(DB_PATH, backup_path)
 
 def _now_iso() -> str:
     return datetime.now().replace(microsecond=0).isoformat(sep=" ")
 
-def get_conn() -> sqlite3.Connection:
+def _open_conn() -> sqlite3.Connection:
+    global _wal_set
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
     _restore_from_latest_backup_if_needed()
-    conn = sqlite3.connect(DB_PATH)
+    # Autocommit mode: writers open their transaction with an explicit BEGIN
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    if not _wal_set:
+        # journal_mode is persisted in the file, so it only needs setting once
+        conn.execute("PRAGMA journal_mode=WAL")
+        _wal_set = True
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA mmap_size=268435456")
     return conn
 
+def get_conn() -> sqlite3.Connection:
+    # One connection per process, shared across Streamlit reruns/sessions.
+    # Callers must hold _conn_lock while using it.
+    global _conn
+    with _conn_lock:
+        if _conn is None:
+            _conn = _open_conn()
+        return _conn
+
 def init_db() -> None:
-    with get_conn() as conn:
+    with _conn_lock, get_conn() as conn:
         conn.execute("""
         CREATE TABLE IF NOT EXISTS scheduled_activities (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -76,28 +144,49 @@ def init_db() -> None:
             ts TEXT NOT NULL
         )
         """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sched_date ON scheduled_activities(scheduled_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_spec_date ON scheduled_activities(specialist, scheduled_date)")
+        if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+            # Range filters compare scheduled_date as text; canonicalize legacy rows once
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(_NORMALIZE_SCHEDULED_DATE_SQL, _non_canonical_dates(conn))
+            conn.execute("PRAGMA user_version = 1")
         conn.commit()
     _backup_db()
 
+def _non_canonical_dates(conn: sqlite3.Connection) -> list[tuple[str, int]]:
+    rows = conn.execute(
+        "SELECT id, scheduled_date FROM scheduled_activities "
+        "WHERE scheduled_date NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'"
+    ).fetchall()
+    fixed = []
+    for rid, value in rows:
+        try:
+            fixed.append((pd.Timestamp(value).date().isoformat(), rid))
+        except (ValueError, TypeError):
+            continue  # leave unparseable values untouched
+    return fixed
+
 def add_scheduled_records(records: list[dict[str, Any]]) -> None:
     if not records:
         return
-    with get_conn() as conn:
-        for r in records:
-            conn.execute("""
-            INSERT INTO scheduled_activities
-            (specialist, activity, unit, scheduled_date, status, notes, created_at, created_by)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                r["specialist"],
-                r["activity"],
-                r["unit"],
-                r["scheduled_date"],
-                r.get("status", "") or "",
-                r.get("notes", "") or "",
-                _now_iso(),
-                r.get("created_by", "—") or "—",
-            ))
+    now = _now_iso()
+    rows = [
+        (
+            r["specialist"],
+            r["activity"],
+            r["unit"],
+            r["scheduled_date"],
+            r.get("status", "") or "",
+            r.get("notes", "") or "",
+            now,
+            r.get("created_by", "—") or "—",
+        )
+        for r in records
+    ]
+    with _conn_lock, get_conn() as conn:
+        conn.execute("BEGIN")
+        conn.executemany(_INSERT_SCHEDULED_SQL, rows)
         conn.commit()
     _backup_db()
 
@@ -105,37 +194,56 @@ def get_month_records(date_from: date, date_to: date, specialist: str | None = N
     q = """
     SELECT id, specialist, activity, unit, scheduled_date, status, notes, updated_at
     FROM scheduled_activities
-    WHERE date(scheduled_date) >= date(?) AND date(scheduled_date) <= date(?)
+    WHERE scheduled_date >= ? AND scheduled_date <= ?
     """
     params: list[Any] = [date_from.isoformat(), date_to.isoformat()]
     if specialist:
         q += " AND specialist = ?"
         params.append(specialist)
-    q += " ORDER BY date(scheduled_date) ASC, specialist ASC, activity ASC"
-    with get_conn() as conn:
+    q += " ORDER BY scheduled_date ASC, specialist ASC, activity ASC"
+    with _conn_lock, get_conn() as conn:
         rows = conn.execute(q, params).fetchall()
     if not rows:
         return pd.DataFrame(columns=["id","scheduled_date","specialist","activity","unit","status","notes","updated_at"])
-    df = pd.DataFrame([dict(r) for r in rows])
-    df["scheduled_date"] = pd.to_datetime(df["scheduled_date"]).dt.date
+    cols = ["id", "specialist", "activity", "unit", "scheduled_date", "status", "notes", "updated_at"]
+    df = pd.DataFrame.from_records(rows, columns=cols)
+    df["scheduled_date"] = pd.to_datetime(df["scheduled_date"], format="%Y-%m-%d", cache=True).dt.date
+    # Repeated labels as categoricals: smaller frames for st.data_editor and faster groupbys
+    df["id"] = df["id"].astype("int32")
+    df["specialist"] = df["specialist"].astype("category")
+    df["unit"] = df["unit"].astype("category")
+    df["status"] = df["status"].astype(STATUS_DTYPE)
     return df
 
 def update_records_status_and_notes(changes: list[dict[str, Any]]) -> None:
     if not changes:
         return
-    with get_conn() as conn:
-        for ch in changes:
-            conn.execute("""
-            UPDATE scheduled_activities
-            SET status = ?, notes = ?, updated_at = ?, updated_by = ?
-            WHERE id = ?
-            """, (
-                ch.get("status", "") or "",
-                ch.get("notes", "") or "",
-                _now_iso(),
-                ch.get("actor", "—") or "—",
-                int(ch["id"]),
-            ))
+    now = _now_iso()
+    rows = [
+        (
+            int(ch["id"]),
+            ch.get("status", "") or "",
+            ch.get("notes", "") or "",
+            ch.get("actor", "—") or "—",
+        )
+        for ch in changes
+    ]
+    with _conn_lock, get_conn() as conn:
+        conn.execute("BEGIN")
+        if sqlite3.sqlite_version_info >= (3, 33, 0):
+            # One UPDATE ... FROM (VALUES ...) per batch instead of one UPDATE per row
+            for start in range(0, len(rows), _UPDATE_BATCH_ROWS):
+                batch = rows[start:start + _UPDATE_BATCH_ROWS]
+                values = ", ".join(["(?, ?, ?, ?)"] * len(batch))
+                params: list[Any] = [now]
+                for row in batch:
+                    params.extend(row)
+                conn.execute(_UPDATE_STATUS_NOTES_FROM_VALUES_SQL.format(values=values), params)
+        else:
+            conn.executemany(
+                _UPDATE_STATUS_NOTES_SQL,
+                [(status, notes, now, actor, rec_id) for rec_id, status, notes, actor in rows],
+            )
         conn.commit()
     _backup_db()
 
@@ -147,7 +255,8 @@ def upsert_records_from_excel(records: list[dict[str, Any]], actor: str) -> tupl
     if not records:
         return inserted, updated, errors
 
-    with get_conn() as conn:
+    with _conn_lock, get_conn() as conn:
+        conn.execute("BEGIN")
         for idx, r in enumerate(records, start=1):
             try:
                 specialist = (r.get("specialist") or "").strip()
@@ -165,32 +274,25 @@ def upsert_records_from_excel(records: list[dict[str, Any]], actor: str) -> tupl
                     errors.append(f"Fila {idx}: status inválido '{status}'. Usa '', '✓' o '✗'.")
                     continue
                 try:
-                    date.fromisoformat(scheduled_date)
+                    # Store canonical yyyy-mm-dd so plain string range filters hit the index
+                    scheduled_date = date.fromisoformat(scheduled_date).isoformat()
                 except ValueError:
                     errors.append(f"Fila {idx}: scheduled_date inválida '{scheduled_date}'. Usa YYYY-MM-DD.")
                     continue
 
                 if record_id is not None and str(record_id).strip() != "":
                     rec_id = int(record_id)
-                    exists = conn.execute("SELECT id FROM scheduled_activities WHERE id = ?", (rec_id,)).fetchone()
+                    exists = conn.execute(_SELECT_ID_SQL, (rec_id,)).fetchone()
                     if exists:
                         conn.execute(
-                            """
-                            UPDATE scheduled_activities
-                            SET specialist = ?, activity = ?, unit = ?, scheduled_date = ?, status = ?, notes = ?, updated_at = ?, updated_by = ?
-                            WHERE id = ?
-                            """,
+                            _UPSERT_UPDATE_SQL,
                             (specialist, activity, unit, scheduled_date, status, notes, _now_iso(), actor, rec_id),
                         )
                         updated += 1
                         continue
 
                 conn.execute(
-                    """
-                    INSERT INTO scheduled_activities
-                    (specialist, activity, unit, scheduled_date, status, notes, created_at, created_by, updated_at, updated_by)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
+                    _UPSERT_INSERT_SQL,
                     (specialist, activity, unit, scheduled_date, status, notes, _now_iso(), actor, _now_iso(), actor),
                 )
                 inserted += 1
@@ -202,119 +304,143 @@ def upsert_records_from_excel(records: list[dict[str, Any]], actor: str) -> tupl
     return inserted, updated, errors
 
 def admin_update_scheduled_date(record_id: int, new_date: str, actor: str, reason: str) -> bool:
-    with get_conn() as conn:
-        row = conn.execute("SELECT scheduled_date FROM scheduled_activities WHERE id = ?", (record_id,)).fetchone()
+    now = _now_iso()
+    with _conn_lock, get_conn() as conn:
+        # Read, write and audit in one write transaction
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(_SELECT_SCHEDULED_DATE_SQL, (record_id,)).fetchone()
         if not row:
             return False
         old = row["scheduled_date"]
-        conn.execute("UPDATE scheduled_activities SET scheduled_date = ?, updated_at = ?, updated_by = ? WHERE id = ?",
-                     (new_date, _now_iso(), actor, record_id))
-        conn.execute("""
-        INSERT INTO audit_log (action, record_id, old_scheduled_date, new_scheduled_date, actor, reason, ts)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, ("UPDATE_DATE", record_id, old, new_date, actor, reason, _now_iso()))
+        conn.execute(_UPDATE_SCHEDULED_DATE_SQL, (new_date, now, actor, record_id))
+        conn.execute(_INSERT_AUDIT_SQL, ("UPDATE_DATE", record_id, old, new_date, actor, reason, now))
         conn.commit()
         _backup_db()
         return True
 
 def admin_delete_record(record_id: int, actor: str, reason: str) -> bool:
-    with get_conn() as conn:
-        row = conn.execute("SELECT scheduled_date FROM scheduled_activities WHERE id = ?", (record_id,)).fetchone()
+    now = _now_iso()
+    with _conn_lock, get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(_SELECT_SCHEDULED_DATE_SQL, (record_id,)).fetchone()
         if not row:
             return False
         old = row["scheduled_date"]
-        conn.execute("DELETE FROM scheduled_activities WHERE id = ?", (record_id,))
-        conn.execute("""
-        INSERT INTO audit_log (action, record_id, old_scheduled_date, new_scheduled_date, actor, reason, ts)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, ("DELETE", record_id, old, None, actor, reason, _now_iso()))
+        conn.execute(_DELETE_SCHEDULED_SQL, (record_id,))
+        conn.execute(_INSERT_AUDIT_SQL, ("DELETE", record_id, old, None, actor, reason, now))
         conn.commit()
         _backup_db()
         return True
 
 # ---------- Excel export (matrix style) ----------
+@lru_cache(maxsize=None)
+def matrix_styles() -> dict[str, dict[str, Any]]:
+    from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+
+    # Style objects are built once and shared by every export (db and app)
+    thin = Side(style="thin", color="9E9E9E")
+    border_thin = Border(left=thin, right=thin, top=thin, bottom=thin)
+    center = Alignment(horizontal="center", vertical="center", wrap_text=True)
+    return {
+        "title": {"font": Font(size=14, bold=True, color="1F4E79")},
+        "legend": {"font": Font(size=11, color="1F4E79")},
+        "header": {
+            "fill": PatternFill("solid", fgColor="1F4E79"),
+            "font": Font(color="FFFFFF", bold=True),
+            "alignment": center,
+            "border": border_thin,
+        },
+        "left": {"alignment": Alignment(horizontal="left", vertical="center", wrap_text=True), "border": border_thin},
+        "center": {"alignment": center, "border": border_thin},
+    }
+
+def styled_cell(ws, value: Any, **style: Any) -> Cell:
+    from openpyxl.cell import WriteOnlyCell
+
+    cell = WriteOnlyCell(ws, value=value)
+    for attr, val in style.items():
+        setattr(cell, attr, val)
+    return cell
+
 def export_month_matrix_xlsx_bytes(month_first: date, month_last: date, specialist: str | None = None) -> bytes:
-    df = get_month_records(month_first, month_last, specialist=specialist)
-    # Pivot: rows = (specialist, activity, unit), cols = day, values = status
-    if df.empty:
+    # openpyxl is only needed here; importing it lazily keeps it off the app's startup path
+    from io import BytesIO
+
+    from openpyxl import Workbook
+    from openpyxl.utils import get_column_letter
+
+    max_day = month_last.day
+    # Pivot in SQL: rows = (specialist, activity, unit), cols = day, values = status.
+    # Like pivot_table(aggfunc="first"), each cell keeps only the first record (lowest id)
+    # of its (specialist, activity, unit, day); MAX then just picks that single status.
+    day_exprs = ", ".join(
+        f"MAX(CASE WHEN CAST(strftime('%d', scheduled_date) AS INTEGER) = {d} THEN status END) AS d{d}"
+        for d in range(1, max_day + 1)
+    )
+    scope = "scheduled_date >= ? AND scheduled_date <= ?"
+    params: list[Any] = [month_first.isoformat(), month_last.isoformat()]
+    if specialist:
+        scope += " AND specialist = ?"
+        params.append(specialist)
+    q = f"""
+    SELECT specialist, activity, unit, {day_exprs}
+    FROM scheduled_activities
+    WHERE id IN (
+        SELECT MIN(id) FROM scheduled_activities
+        WHERE {scope}
+        GROUP BY specialist, activity, unit, scheduled_date
+    )
+    GROUP BY specialist, activity, unit
+    ORDER BY specialist ASC, activity ASC, unit ASC
+    """
+    with _conn_lock, get_conn() as conn:
+        rows = conn.execute(q, params).fetchall()
+
+    if not rows:
         wb = Workbook()
         ws = wb.active
         ws.title = "Matriz"
         ws["A1"] = "Sin datos para el rango seleccionado"
-        from io import BytesIO
         bio = BytesIO()
         wb.save(bio)
         return bio.getvalue()
 
-    df["day"] = pd.to_datetime(df["scheduled_date"]).dt.day
-    pivot = df.pivot_table(
-        index=["specialist", "activity", "unit"],
-        columns="day",
-        values="status",
-        aggfunc="first",
-        fill_value="",
-    ).reset_index()
-
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Matriz"
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Matriz")
     ws.sheet_view.showGridLines = False
 
-    # Styles
-    header_fill = PatternFill("solid", fgColor="1F4E79")
-    header_font = Font(color="FFFFFF", bold=True)
-    thin = Side(style="thin", color="9E9E9E")
-    border_thin = Border(left=thin, right=thin, top=thin, bottom=thin)
-    center = Alignment(horizontal="center", vertical="center", wrap_text=True)
-    left = Alignment(horizontal="left", vertical="center", wrap_text=True)
-
-    ws["A1"] = f"Matriz mensual: {month_first.strftime('%Y-%m')}"
-    ws["A1"].font = Font(size=14, bold=True, color="1F4E79")
-    ws.merge_cells("A1:AI1")
-
-    header_row = 3
-    headers = ["Especialista", "Actividad", "Unidad de medida"]
-    max_day = month_last.day
+    sty = matrix_styles()
 
-    for j, h in enumerate(headers, start=1):
-        c = ws.cell(row=header_row, column=j, value=h)
-        c.fill = header_fill
-        c.font = header_font
-        c.alignment = center
-        c.border = border_thin
-
-    # Day columns
-    for d in range(1, max_day + 1):
-        col = 3 + d
-        c = ws.cell(row=header_row, column=col, value=d)
-        c.fill = header_fill
-        c.font = header_font
-        c.alignment = center
-        c.border = border_thin
-
-    # Column widths
+    # Column widths and merges must be set before rows are streamed
     ws.column_dimensions["A"].width = 24
     ws.column_dimensions["B"].width = 38
     ws.column_dimensions["C"].width = 18
     for d in range(1, max_day + 1):
         ws.column_dimensions[get_column_letter(3 + d)].width = 4.2
+    ws.merged_cells.add("A1:AI1")
+
+    ws.append([styled_cell(ws, f"Matriz mensual: {month_first.strftime('%Y-%m')}", **sty["title"])])
+    ws.append([])
+
+    # Header: fixed columns + day columns
+    headers: list[Any] = ["Especialista", "Actividad", "Unidad de medida", *range(1, max_day + 1)]
+    ws.append([styled_cell(ws, h, **sty["header"]) for h in headers])
 
     # Data rows
-    start_row = header_row + 1
-    for i, row in enumerate(pivot.itertuples(index=False), start=start_row):
-        ws.cell(i, 1, row.specialist).alignment = left
-        ws.cell(i, 2, row.activity).alignment = left
-        ws.cell(i, 3, row.unit).alignment = center
-        for c in range(1, 3 + max_day + 1):
-            ws.cell(i, c).border = border_thin
-
-        # Fill days
-        for d in range(1, max_day + 1):
-            val = getattr(row, str(d), "")
-            ws.cell(i, 3 + d, val).alignment = center
+    for row in rows:
+        ws.append(
+            [
+                styled_cell(ws, row["specialist"], **sty["left"]),
+                styled_cell(ws, row["activity"], **sty["left"]),
+                styled_cell(ws, row["unit"], **sty["center"]),
+            ]
+            + [
+                styled_cell(ws, row[f"d{d}"] or "", **sty["center"])
+                for d in range(1, max_day + 1)
+            ]
+        )
 
     # Output to bytes
-    from io import BytesIO
     bio = BytesIO()
     wb.save(bio)
     return bio.getvalue()